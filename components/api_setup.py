@@ -1,31 +1,85 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import time
 import streamlit as st
-import psycopg2.extras
-from database.db import Database
-from binance.client import Client
+from types import MappingProxyType
+from database.db import get_db
+from services.binance_service import BinanceService, get_binance_service
+from components.charts import load_balance_history
 from binance.exceptions import BinanceAPIException
 
+_HELP_MD = """
+### 获取币安API密钥的步骤：
+1. 登录您的币安账户
+2. 进入 [API管理页面](https://www.binance.com/cn/my/settings/api-management)
+3. 点击"创建API"按钮
+4. 完成安全验证
+5. 设置API权限：
+   - ✓ 只启用读取权限（重要！其他权限请勿开启）
+   - ✓ 确保现货和合约交易的读取权限已启用
+6. 复制并保存好API密钥和密钥
+
+### 📢 重要提示：
+- 请勿泄露您的API密钥
+- 建议定期更新API密钥以确保安全
+- 如遇问题，请检查网络连接或尝试重新生成API密钥
+"""
+
+_API_ERROR_MESSAGES = MappingProxyType({
+    -2015: "API密钥无效或权限不足，请确保已启用读取权限",
+    -1022: "API签名无效，请检查密钥是否正确",
+    -1102: "必需参数无效，请重新检查输入",
+    -2014: "服务器拒绝访问，请检查IP白名单设置",
+    -1021: "请求超时，请检查网络连接"
+})
+
+# 这些错误码在用户修改密钥/权限后可能立即改变，不缓存
+_UNCACHED_ERROR_CODES = frozenset({-2015, -1022, -1021})
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _probe(api_key, api_secret):
+    """测试API连接并检查权限（失败时抛出异常，不会被缓存）"""
+    # 使用不缓存的服务实例，输错或被拒绝的密钥不会驻留在get_binance_service中
+    # （仍共用HTTP会话、超时和响应解析设置）
+    client = BinanceService(api_key, api_secret).client
+    # 现货和合约权限并发检查，耗时取两者中较慢的一次
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        spot_check = executor.submit(client.get_account)
+        futures_check = executor.submit(client.futures_account_balance)
+        spot_check.result()
+        futures_check.result()
+    return True
+
+class _UncachedResult(Exception):
+    """携带不应被缓存的验证结果（lru_cache不会缓存异常）"""
+
+def _do_validate(api_key, api_secret):
+    """执行API验证，密钥无效/签名错误/网络问题以_UncachedResult抛出"""
+    try:
+        _probe(api_key, api_secret)
+        return True, "API验证成功"
+    except BinanceAPIException as e:
+        message = _API_ERROR_MESSAGES.get(e.code, f"API错误 ({e.code}): {e.message}")
+        if e.code in _UNCACHED_ERROR_CODES:
+            raise _UncachedResult(message)
+        return False, message
+    except Exception as e:
+        raise _UncachedResult(f"连接错误: {str(e)}")
+
+@functools.lru_cache(maxsize=5)
+def _cached_validate(api_key, api_secret, epoch_minute):
+    """按(密钥, 分钟)缓存验证结果，同一分钟内重复提交直接命中"""
+    return _do_validate(api_key, api_secret)
+
 def validate_api_keys(api_key, api_secret):
     """验证API密钥有效性"""
     if not api_key or not api_secret:
         return False, "API密钥和密钥不能为空"
 
     try:
-        client = Client(api_key, api_secret)
-        # 测试API连接并检查权限
-        account = client.get_account()
-        futures_account = client.futures_account_balance()
-        return True, "API验证成功"
-    except BinanceAPIException as e:
-        error_messages = {
-            -2015: "API密钥无效或权限不足，请确保已启用读取权限",
-            -1022: "API签名无效，请检查密钥是否正确",
-            -1102: "必需参数无效，请重新检查输入",
-            -2014: "服务器拒绝访问，请检查IP白名单设置",
-            -1021: "请求超时，请检查网络连接"
-        }
-        return False, error_messages.get(e.code, f"API错误 ({e.code}): {e.message}")
-    except Exception as e:
-        return False, f"连接错误: {str(e)}"
+        return _cached_validate(api_key, api_secret, int(time.time() // 60))
+    except _UncachedResult as e:
+        return False, str(e)
 
 def validate_investment_amount(amount):
     """验证投资金额"""
@@ -41,49 +95,32 @@ def validate_investment_amount(amount):
     except ValueError:
         return False, "请输入有效的数字"
 
+@st.cache_data(ttl=30, show_spinner=False)
+def _load_latest_config(session_id):
+    """读取当前会话的默认API配置（短时缓存，保存/重置时清除）"""
+    config = get_db().get_latest_config(session_id)
+    return dict(config) if config else None
+
+@st.fragment
 def render_api_setup(session_id):
     st.header("⚙️ API设置")
 
     # Get existing API configurations
-    db = Database()
+    db = get_db()
     existing_configs = []
     try:
-        # Execute a query to get all configs for this session
-        with db.conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("""
-                SELECT api_name, api_key, api_secret, total_investment 
-                FROM user_config 
-                WHERE session_id = %s 
-                ORDER BY api_name
-            """, (session_id,))
-            existing_configs = cur.fetchall()
+        existing_configs = db.get_all_configs(session_id)
     except Exception as e:
         st.error(f"获取API配置失败: {str(e)}")
 
     # 添加API设置说明
     with st.expander("📖 使用说明", expanded=False):
-        st.markdown("""
-        ### 获取币安API密钥的步骤：
-        1. 登录您的币安账户
-        2. 进入 [API管理页面](https://www.binance.com/cn/my/settings/api-management)
-        3. 点击"创建API"按钮
-        4. 完成安全验证
-        5. 设置API权限：
-           - ✓ 只启用读取权限（重要！其他权限请勿开启）
-           - ✓ 确保现货和合约交易的读取权限已启用
-        6. 复制并保存好API密钥和密钥
-
-        ### 📢 重要提示：
-        - 请勿泄露您的API密钥
-        - 建议定期更新API密钥以确保安全
-        - 如遇问题，请检查网络连接或尝试重新生成API密钥
-        """)
+        st.markdown(_HELP_MD)
 
-    db = Database()
     config = None
 
     try:
-        config = db.get_latest_config(session_id)
+        config = _load_latest_config(session_id)
     except Exception as e:
         st.warning("""
         ### ⚠️ 无法连接数据库
@@ -104,6 +141,9 @@ def render_api_setup(session_id):
         if st.button("🔄 重置设置", use_container_width=True, help="清除所有现有配置和历史数据，重新开始设置"):
             try:
                 db.clear_config(session_id)
+                get_binance_service.clear()
+                _load_latest_config.clear()
+                load_balance_history.clear()
                 st.success("""
                 ### ✅ 重置成功！
                 
@@ -131,12 +171,10 @@ def render_api_setup(session_id):
                 st.text(f"投资金额: {config['total_investment']} USDT")
                 if st.button("删除", key=f"delete_{config['api_name']}"):
                     try:
-                        with db.conn.cursor() as cur:
-                            cur.execute("""
-                                DELETE FROM user_config 
-                                WHERE session_id = %s AND api_name = %s
-                            """, (session_id, config['api_name']))
-                        db.conn.commit()
+                        db.delete_config(session_id, config['api_name'])
+                        get_binance_service.clear()
+                        _load_latest_config.clear()
+                        load_balance_history.clear()
                         st.success(f"已删除 {config['api_name']} 配置")
                         st.rerun()
                     except Exception as e:
@@ -218,6 +256,9 @@ def render_api_setup(session_id):
                         raise ValueError("API名称不能为空")
                         
                     db.save_config(api_key, api_secret, total_investment, session_id, api_name)
+                    _probe.clear()
+                    _cached_validate.cache_clear()
+                    _load_latest_config.clear()
                     status.update(label="✅ 设置保存成功！", state="complete")
                     st.success(f"""
                     ### ✅ API配置 '{api_name}' 保存成功！
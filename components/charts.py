@@ -1,60 +1,116 @@
 import streamlit as st
 import plotly.graph_objects as go
+import plotly.io as pio
 import pandas as pd
-from utils.calculations import to_float, calculate_profit_rate
+import numpy as np
+from database.db import get_db
+from utils.calculations import calculate_profit_rate, calculate_profit_rates
 from datetime import datetime
 import pytz
 
-def render_profit_charts(total_value, config, balance_history):
+REQUIRED_COLUMNS = [
+    'spot_value', 'futures_value', 'coin_futures_value',
+    'cross_margin_value', 'isolated_margin_value',
+    'total_value', 'recorded_at'
+]
+
+NUMERIC_COLUMNS = [
+    'spot_value', 'futures_value', 'coin_futures_value',
+    'cross_margin_value', 'isolated_margin_value', 'total_value'
+]
+
+def _history_bucket(hours):
+    """根据时间范围选择降采样粒度（秒），使返回点数与图表像素相当"""
+    if hours and hours <= 1:
+        return 60
+    if hours and hours <= 24:
+        return 300
+    # 长时间范围和全部历史都按小时聚合，LIMIT内可覆盖一年以上的数据
+    return 3600
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_balance_history(session_id, hours=None):
+    """读取历史数据并转换为DataFrame（按session_id和hours缓存）"""
+    balance_history = get_db().get_balance_history(
+        session_id, hours, bucket=_history_bucket(hours)
+    )
+    if not balance_history:
+        return pd.DataFrame(columns=REQUIRED_COLUMNS)
+
+    # Validate data structure
+    if not all(isinstance(entry, dict) for entry in balance_history):
+        raise ValueError("历史数据格式不正确")
+    
+    # Rows come from a single query, so the first row's keys describe them all
+    first_keys = set(balance_history[0].keys())
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in first_keys]
+    if missing_columns:
+        print(f"Missing columns in balance history: {missing_columns}")
+
+    # Convert to DataFrame; missing columns are added by reindex and zero-filled below
+    df = pd.DataFrame(balance_history).reindex(columns=REQUIRED_COLUMNS)
+    df['recorded_at'] = pd.to_datetime(df['recorded_at'], utc=True, cache=True)
+    df[NUMERIC_COLUMNS] = df[NUMERIC_COLUMNS].apply(pd.to_numeric, errors='coerce').fillna(0.0)
+    return df
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _build_profit_fig(cache_key, _df):
+    """构建收益率趋势图并返回JSON；_df不参与哈希，由cache_key区分数据"""
+    fig = go.Figure()
+    
+    # Add profit rate line with datetime handling
+    fig.add_trace(go.Scatter(
+        x=_df['recorded_at'],
+        y=_df['profit_rate'],
+        name="收益率",
+        line=dict(color='rgba(100, 181, 246, 1)', width=2),
+        hovertemplate='时间: %{x}<br>收益率: %{y:.2f}%<extra></extra>'
+    ))
+    
+    # Update layout with proper time formatting
+    fig.update_layout(
+        xaxis_title='时间',
+        yaxis_title='收益率 (%)',
+        height=500,
+        hovermode='x unified',
+        showlegend=False,
+        yaxis=dict(
+            tickformat='.2f',
+            ticksuffix='%',
+            gridcolor='rgba(0,0,0,0.1)',
+            zerolinecolor='rgba(0,0,0,0.2)'
+        ),
+        xaxis=dict(
+            type='date',
+            tickformat='%Y-%m-%d %H:%M',
+            gridcolor='rgba(0,0,0,0.1)',
+            tickangle=-45
+        ),
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        margin=dict(t=20, b=40)
+    )
+    
+    # Add gridlines
+    fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='rgba(0,0,0,0.1)')
+    fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='rgba(0,0,0,0.1)')
+    
+    return fig.to_json()
+
+def render_profit_charts(total_value, config, session_id, hours=None):
     st.header("📈 收益趋势分析")
     
     try:
-        # Data validation
-        if not balance_history or len(balance_history) == 0:
-            st.info("暂无历史数据，随着时间推移将会显示资产趋势图")
+        try:
+            df = load_balance_history(session_id, hours)
+        except Exception as e:
+            st.error(f"历史数据加载错误: {str(e)}")
             return
 
-        # Validate data structure
-        required_columns = [
-            'spot_value', 'futures_value', 'coin_futures_value',
-            'cross_margin_value', 'isolated_margin_value',
-            'total_value', 'recorded_at'
-        ]
-        if not all(isinstance(entry, dict) for entry in balance_history):
-            st.error("数据格式错误：历史数据格式不正确")
+        # Data validation
+        if df.empty:
+            st.info("暂无历史数据，随着时间推移将会显示资产趋势图")
             return
-        
-        missing_columns = [col for col in required_columns if not all(col in entry for entry in balance_history)]
-        if missing_columns:
-            print(f"Missing columns in balance history: {missing_columns}")
-            # Initialize missing columns with 0
-            for entry in balance_history:
-                for col in missing_columns:
-                    entry[col] = 0.0
-
-        # Convert to DataFrame with proper timestamp handling
-        df = pd.DataFrame(balance_history)
-        
-        # Ensure recorded_at is datetime
-        if not pd.api.types.is_datetime64_any_dtype(df['recorded_at']):
-            try:
-                df['recorded_at'] = pd.to_datetime(df['recorded_at'], utc=True)
-            except Exception as e:
-                st.error(f"时间戳转换错误: {str(e)}")
-                return
-        
-        # Convert numeric columns with validation
-        numeric_columns = [
-            'spot_value', 'futures_value', 'coin_futures_value',
-            'cross_margin_value', 'isolated_margin_value', 'total_value'
-        ]
-        for col in numeric_columns:
-            try:
-                df[col] = df[col].apply(lambda x: to_float(x) if x is not None else 0.0)
-            except Exception as e:
-                st.error(f"数值转换错误 ({col}): {str(e)}")
-                print(f"Error converting {col}: {str(e)}")
-                return
 
         # 获取并验证total_investment
         try:
@@ -62,7 +118,7 @@ def render_profit_charts(total_value, config, balance_history):
             if total_investment is None:
                 st.warning("未设置初始投资金额，请先在设置页面填写投资金额")
                 return
-            total_investment = to_float(total_investment)
+            total_investment = float(total_investment)
             if total_investment <= 0:
                 st.warning("初始投资金额必须大于0")
                 return
@@ -70,58 +126,27 @@ def render_profit_charts(total_value, config, balance_history):
             st.error(f"投资金额计算错误: {str(e)}")
             return
             
-        # 计算profit rate前确保数值有效
-        df['profit_rate'] = df.apply(
-            lambda row: calculate_profit_rate(row['total_value'], total_investment), 
-            axis=1
+        # total_investment已验证大于0，直接按列计算收益率（非有限值记为0）
+        tv = df['total_value'].to_numpy(dtype=np.float64)
+        df['profit_rate'] = np.where(
+            np.isfinite(tv), calculate_profit_rates(tv, total_investment), 0.0
         )
         
-        # Create trend chart
-        fig = go.Figure()
-        
-        # Add profit rate line with datetime handling
-        fig.add_trace(go.Scatter(
-            x=df['recorded_at'],
-            y=df['profit_rate'],
-            name="收益率",
-            line=dict(color='rgba(100, 181, 246, 1)', width=2),
-            hovertemplate='时间: %{x}<br>收益率: %{y:.2f}%<extra></extra>'
-        ))
-        
-        # Update layout with proper time formatting
-        fig.update_layout(
-            xaxis_title='时间',
-            yaxis_title='收益率 (%)',
-            height=500,
-            hovermode='x unified',
-            showlegend=False,
-            yaxis=dict(
-                tickformat='.2f',
-                ticksuffix='%',
-                gridcolor='rgba(0,0,0,0.1)',
-                zerolinecolor='rgba(0,0,0,0.2)'
-            ),
-            xaxis=dict(
-                type='date',
-                tickformat='%Y-%m-%d %H:%M',
-                gridcolor='rgba(0,0,0,0.1)',
-                tickangle=-45
-            ),
-            plot_bgcolor='white',
-            paper_bgcolor='white',
-            margin=dict(t=20, b=40)
+        # Create trend chart (cached by a cheap digest of the plotted series)
+        cache_key = (
+            len(df),
+            df['recorded_at'].max().value,
+            float(df['profit_rate'].sum()),
+            total_investment
         )
-        
-        # Add gridlines
-        fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='rgba(0,0,0,0.1)')
-        fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='rgba(0,0,0,0.1)')
+        fig = pio.from_json(_build_profit_fig(cache_key, df[['recorded_at', 'profit_rate']]))
         
         st.plotly_chart(fig, use_container_width=True)
         
         # Display current profit rate with validation
         try:
             if total_value is not None:
-                current_profit_rate = calculate_profit_rate(to_float(total_value), total_investment)
+                current_profit_rate = calculate_profit_rate(total_value, total_investment)
                 st.metric("当前收益率", f"{current_profit_rate:.2f}%")
         except Exception as e:
             st.error(f"当前收益率计算错误: {str(e)}")
@@ -1,56 +1,68 @@
+from types import MappingProxyType
 import streamlit as st
 import pandas as pd
 from binance.exceptions import BinanceAPIException
 from services.binance_service import BinanceService
-from utils.calculations import calculate_profit_rate, format_currency, format_percentage, to_float
+from utils.calculations import calculate_profit_rate, format_currency, format_percentage
 
-def check_api_permissions(binance_service):
-    """检查API权限"""
+_PERMISSION_ERROR_MESSAGES = MappingProxyType({
+    -2015: """
+    ### 🚫 API权限验证失败
+
+    #### 可能的原因：
+    1. **API密钥无效**：密钥可能已过期或被删除
+    2. **权限不足**：API未启用必要的权限
+    3. **IP限制**：当前IP地址未被允许访问
+
+    #### 解决步骤：
+    1. 访问[币安API管理页面](https://www.binance.com/cn/my/settings/api-management)
+    2. 确保以下权限已启用：
+       - ✓ 允许读取账户信息
+       - ✓ 允许读取现货和合约数据
+    3. 检查IP限制设置：
+       - 移除特定IP限制或
+       - 添加当前IP到白名单
+
+    #### 建议操作：
+    1. 如果以上设置正确但仍然失败，建议：
+       - 重新生成API密钥
+       - 仔细复制新的密钥信息
+       - 更新应用设置
+    """,
+    -1021: "请求超时，正在重试...",
+    -1022: "API签名无效，请检查密钥设置",
+    -1102: "无效的参数，请联系技术支持"
+})
+
+_FETCH_ERROR_MESSAGES = MappingProxyType({
+    -2015: "API '{api_name}' 密钥无效或权限不足",
+    -1021: "API '{api_name}' 请求超时，请稍后重试",
+    -1022: "API '{api_name}' 签名无效，请检查设置",
+    -1102: "API '{api_name}' 参数错误，请联系技术支持"
+})
+
+def check_api_permissions(binance_service, account_result=None, api_name='default'):
+    """检查API权限（api_name用于区分多个API的按钮key）"""
     st.info("正在验证API权限...")
     try:
-        # 尝试获取账户信息来验证API权限
-        binance_service.client.get_account()
+        # 尝试获取账户信息来验证API权限（可使用已获取的现货账户结果）
+        if account_result is None:
+            binance_service.client.get_account()
+        elif isinstance(account_result, Exception):
+            raise account_result
         st.success("✅ API验证成功")
         return True
     except BinanceAPIException as e:
-        error_messages = {
-            -2015: """
-            ### 🚫 API权限验证失败
-            
-            #### 可能的原因：
-            1. **API密钥无效**：密钥可能已过期或被删除
-            2. **权限不足**：API未启用必要的权限
-            3. **IP限制**：当前IP地址未被允许访问
-            
-            #### 解决步骤：
-            1. 访问[币安API管理页面](https://www.binance.com/cn/my/settings/api-management)
-            2. 确保以下权限已启用：
-               - ✓ 允许读取账户信息
-               - ✓ 允许读取现货和合约数据
-            3. 检查IP限制设置：
-               - 移除特定IP限制或
-               - 添加当前IP到白名单
-            
-            #### 建议操作：
-            1. 如果以上设置正确但仍然失败，建议：
-               - 重新生成API密钥
-               - 仔细复制新的密钥信息
-               - 更新应用设置
-            """,
-            -1021: "请求超时，正在重试...",
-            -1022: "API签名无效，请检查密钥设置",
-            -1102: "无效的参数，请联系技术支持"
-        }
-        st.error(error_messages.get(e.code, f"币安API错误 (代码: {e.code})\n\n{e.message}"))
+        st.error(_PERMISSION_ERROR_MESSAGES.get(e.code, f"币安API错误 (代码: {e.code})\n\n{e.message}"))
         
         # 显示操作按钮
         col1, col2 = st.columns(2)
         with col1:
-            if st.button("⚙️ 前往设置", use_container_width=True, key="goto_settings_error"):
+            if st.button("⚙️ 前往设置", use_container_width=True, key=f"perm_goto_settings_{api_name}"):
                 st.session_state.current_tab = "⚙️ 设置"
                 st.rerun()
         with col2:
-            st.button("🔄 重新验证", use_container_width=True, key="revalidate_api", on_click=st.rerun)
+            st.button("🔄 重新验证", use_container_width=True, key=f"perm_revalidate_{api_name}", on_click=st.rerun)
         
         return False
     except Exception as e:
@@ -68,18 +80,22 @@ def check_api_permissions(binance_service):
            - 使用不同的网络连接
            - 联系技术支持
         """)
-        st.button("🔄 重试", key="retry_wallet", on_click=st.rerun)
+        st.button("🔄 重试", key=f"perm_retry_{api_name}", on_click=st.rerun)
         return False
 
-def render_wallet_display(binance_service, config):
-    """Display wallet information for multiple APIs"""
+def render_wallet_display(binance_service, config, wallet_result):
+    """
+    Display wallet information for multiple APIs
+    wallet_result: wallet values already fetched by main(), or the exception raised by
+    the spot account request (which doubles as the API permission check)
+    """
     api_name = config.get('api_name', 'default')
     
     # API状态指示器
     with st.status(f"正在连接币安API ({api_name})...", expanded=True) as status:
-        # 首先检查API权限
+        # 首先检查API权限（现货账户请求的结果即权限验证结果）
         try:
-            if not check_api_permissions(binance_service):
+            if not check_api_permissions(binance_service, wallet_result, api_name):
                 status.error(f"API '{api_name}' 验证失败")
                 # Don't return, show retry options
                 st.error(f"""
@@ -112,22 +128,23 @@ def render_wallet_display(binance_service, config):
         
         try:
             # 获取所有钱包价值
-            with st.spinner("获取钱包数据..."):
-                wallet_values = binance_service.get_all_wallet_values()
+            if isinstance(wallet_result, Exception):
+                raise wallet_result
+            wallet_values = wallet_result
             
             # 计算总值
-            spot_value = to_float(wallet_values.get('spot', 0))
-            futures_value = to_float(wallet_values.get('futures', 0))
-            coin_futures_value = to_float(wallet_values.get('coin_futures', 0))
-            cross_margin_value = to_float(wallet_values.get('cross_margin', 0))
-            isolated_margin_value = to_float(wallet_values.get('isolated_margin', 0))
+            spot_value = float(wallet_values.get('spot', 0))
+            futures_value = float(wallet_values.get('futures', 0))
+            coin_futures_value = float(wallet_values.get('coin_futures', 0))
+            cross_margin_value = float(wallet_values.get('cross_margin', 0))
+            isolated_margin_value = float(wallet_values.get('isolated_margin', 0))
             total_value = sum([spot_value, futures_value, coin_futures_value, 
                              cross_margin_value, isolated_margin_value])
             
             status.update(label="✅ 数据获取成功", state="complete")
             
             # 计算收益
-            initial_investment = to_float(config['total_investment'])
+            initial_investment = float(config['total_investment'])
             profit_amount = total_value - initial_investment
             profit_rate = calculate_profit_rate(total_value, initial_investment)
 
@@ -180,14 +197,11 @@ def render_wallet_display(binance_service, config):
                 
         except BinanceAPIException as e:
             status.error("获取数据失败")
-            error_messages = {
-                -2015: f"API '{config.get('api_name', 'default')}' 密钥无效或权限不足",
-                -1021: f"API '{config.get('api_name', 'default')}' 请求超时，请稍后重试",
-                -1022: f"API '{config.get('api_name', 'default')}' 签名无效，请检查设置",
-                -1102: f"API '{config.get('api_name', 'default')}' 参数错误，请联系技术支持"
-            }
-            
-            error_msg = error_messages.get(e.code, f"币安API错误 (代码: {e.code})")
+            error_template = _FETCH_ERROR_MESSAGES.get(e.code)
+            if error_template:
+                error_msg = error_template.format(api_name=api_name)
+            else:
+                error_msg = f"币安API错误 (代码: {e.code})"
             st.error(f"""
             ### ❌ {error_msg}
             
@@ -204,10 +218,10 @@ def render_wallet_display(binance_service, config):
             
             col1, col2 = st.columns(2)
             with col1:
-                st.button("⚙️ 更新设置", key="goto_settings_error", use_container_width=True, 
+                st.button("⚙️ 更新设置", key=f"fetch_goto_settings_{api_name}", use_container_width=True, 
                          on_click=lambda: st.session_state.update({"current_tab": "⚙️ 设置"}))
             with col2:
-                st.button("🔄 重新加载", key="reload_wallet", use_container_width=True, on_click=st.rerun)
+                st.button("🔄 重新加载", key=f"fetch_reload_{api_name}", use_container_width=True, on_click=st.rerun)
             
         except Exception as e:
             status.error("系统错误")
@@ -225,4 +239,4 @@ def render_wallet_display(binance_service, config):
                - 使用不同的网络连接
                - 联系技术支持
             """)
-            st.button("🔄 重试", key="retry_wallet_error", on_click=st.rerun)
+            st.button("🔄 重试", key=f"fetch_retry_{api_name}", on_click=st.rerun)
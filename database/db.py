@@ -1,24 +1,165 @@
+import io
 import os
+import streamlit as st
+import threading
+import time
+import weakref
 import psycopg2
-from psycopg2.extras import DictCursor
-from datetime import datetime, timedelta
-from utils.calculations import to_float
+import psycopg2.extensions
+import psycopg2.pool
+from contextlib import contextmanager
+from psycopg2.extras import DictCursor, RealDictCursor, execute_values
+
+# Return NUMERIC/DECIMAL columns as float instead of Decimal; the values are
+# only used for display, so pandas can build float64 columns directly
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values,
+    'DEC2FLOAT',
+    lambda value, cur: float(value) if value is not None else None
+)
+psycopg2.extensions.register_type(DEC2FLOAT)
+
+# Upper bound on rows the chart path pulls from balance_history
+MAX_HISTORY_ROWS = 10000
+
+class _ConfigCache:
+    """Thread-safe TTL cache for per-session read results"""
+
+    def __init__(self, ttl_seconds=60, max_entries=1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (hit, value); expired entries count as a miss and are dropped"""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return False, None
+            if time.monotonic() >= entry[0]:
+                del self._cache[key]
+                return False, None
+            return True, entry[1]
+
+    def set(self, key, value):
+        """Store a value, sweeping expired entries and evicting the oldest past max_entries"""
+        now = time.monotonic()
+        with self._lock:
+            for expired in [k for k, entry in self._cache.items() if now >= entry[0]]:
+                del self._cache[expired]
+            self._cache.pop(key, None)
+            while len(self._cache) >= self.max_entries:
+                # dicts keep insertion order, so the first key is the oldest entry
+                del self._cache[next(iter(self._cache))]
+            self._cache[key] = (now + self.ttl_seconds, value)
+
+    def invalidate(self, session_id):
+        """Drop every entry for a session (keys start with session_id)"""
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == session_id]:
+                del self._cache[key]
+
+_CONFIG_CACHE = _ConfigCache(ttl_seconds=60)
+_HISTORY_CACHE = _ConfigCache(ttl_seconds=10, max_entries=256)
+
+# Last persisted snapshot per (session_id, api_name): (monotonic time, values)
+# Reruns that land inside the window with unchanged values skip the INSERT
+_LAST_WRITE: dict[tuple, tuple[float, tuple]] = {}
+_LAST_WRITE_LOCK = threading.Lock()
+_WRITE_MIN_INTERVAL = 30
+_WRITE_REL_EPSILON = 1e-4
+
+def _unchanged(previous, current):
+    """True when every value is within the relative epsilon of the previous write"""
+    return all(
+        abs(cur - prev) <= _WRITE_REL_EPSILON * max(abs(prev), abs(cur))
+        for prev, cur in zip(previous, current)
+    )
+
+# minconn == maxconn: psycopg2 closes connections handed back beyond minconn,
+# which would throw away their prepared statements after each burst
+_POOL_SIZE = 10
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _get_pool():
+    """Create the process-wide connection pool on first use"""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = psycopg2.pool.ThreadedConnectionPool(
+                    _POOL_SIZE, _POOL_SIZE,
+                    host=os.environ['PGHOST'],
+                    database=os.environ['PGDATABASE'],
+                    user=os.environ['PGUSER'],
+                    password=os.environ['PGPASSWORD'],
+                    port=os.environ['PGPORT']
+                )
+    return _POOL
+
+@contextmanager
+def _conn():
+    """Borrow a connection from the pool and always hand it back"""
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+# Hot statements prepared once per pooled connection (server-side PREPARE)
+_PREPARED_STATEMENTS = {
+    'save_cfg': """
+        INSERT INTO user_config (api_key, api_secret, total_investment, session_id, api_name)
+        VALUES ($1, $2, $3, $4, $5)
+    """,
+    'get_cfg': """
+        SELECT id, api_key, api_secret, api_name, total_investment, session_id, created_at
+        FROM user_config WHERE session_id = $1 AND api_name = $2
+    """,
+    'get_all_cfg': """
+        SELECT id, api_key, api_secret, api_name, total_investment, session_id, created_at
+        FROM user_config WHERE session_id = $1 ORDER BY api_name
+    """,
+}
+_PREPARED_CONNS = weakref.WeakSet()
+
+def _ensure_prepared(conn):
+    """PREPARE the hot statements on a connection the first time it is used for them"""
+    if conn in _PREPARED_CONNS:
+        return
+    try:
+        with conn.cursor() as cur:
+            # PREPARE survives ROLLBACK, so clear leftovers from an earlier failed attempt
+            cur.execute("DEALLOCATE ALL")
+            for name, statement in _PREPARED_STATEMENTS.items():
+                cur.execute(f"PREPARE {name} AS {statement}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _PREPARED_CONNS.add(conn)
+
+# Set once the schema bootstrap has run in this process
+_SCHEMA_READY = threading.Event()
+_SCHEMA_LOCK = threading.Lock()
 
 class Database:
     def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.environ['PGHOST'],
-            database=os.environ['PGDATABASE'],
-            user=os.environ['PGUSER'],
-            password=os.environ['PGPASSWORD'],
-            port=os.environ['PGPORT']
-        )
-        self._create_tables()
+        # Schema bootstrap only needs to run once per process
+        if not _SCHEMA_READY.is_set():
+            with _SCHEMA_LOCK:
+                if not _SCHEMA_READY.is_set():
+                    self._create_tables()
+                    _SCHEMA_READY.set()
 
     def _create_tables(self):
-        with self.conn.cursor() as cur:
-            # User config table
+        with _conn() as conn, conn.cursor() as cur:
+            # Schema, migration and indexes are sent as one multi-statement round trip
             cur.execute('''
+                -- User config table
                 CREATE TABLE IF NOT EXISTS user_config (
                     id SERIAL PRIMARY KEY,
                     api_key VARCHAR(255),
@@ -27,161 +168,341 @@ class Database:
                     total_investment DECIMAL,
                     session_id VARCHAR(255),
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Balance history table
-            cur.execute('''
+                );
+                
+                -- Balance history table
                 CREATE TABLE IF NOT EXISTS balance_history (
                     id SERIAL PRIMARY KEY,
-                    spot_value DECIMAL NOT NULL DEFAULT 0,
-                    futures_value DECIMAL NOT NULL DEFAULT 0,
-                    coin_futures_value DECIMAL NOT NULL DEFAULT 0,
-                    cross_margin_value DECIMAL NOT NULL DEFAULT 0,
-                    isolated_margin_value DECIMAL NOT NULL DEFAULT 0,
-                    total_value DECIMAL NOT NULL,
+                    spot_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    futures_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    coin_futures_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    cross_margin_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    isolated_margin_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    total_value DOUBLE PRECISION GENERATED ALWAYS AS (
+                        spot_value + futures_value + coin_futures_value
+                        + cross_margin_value + isolated_margin_value
+                    ) STORED,
                     wallet_type VARCHAR(20) DEFAULT 'spot',
                     session_id VARCHAR(255),
                     recorded_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
-                )
-            ''')
-            
-            # Create indexes for better performance
-            cur.execute('''
+                );
+                
+                -- Migrate balance tables created by earlier versions
+                DO $$
+                BEGIN
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = 'balance_history'
+                          AND column_name = 'spot_value'
+                          AND data_type = 'numeric'
+                    ) THEN
+                        ALTER TABLE balance_history
+                            ALTER COLUMN spot_value TYPE DOUBLE PRECISION,
+                            ALTER COLUMN futures_value TYPE DOUBLE PRECISION,
+                            ALTER COLUMN coin_futures_value TYPE DOUBLE PRECISION,
+                            ALTER COLUMN cross_margin_value TYPE DOUBLE PRECISION,
+                            ALTER COLUMN isolated_margin_value TYPE DOUBLE PRECISION,
+                            ALTER COLUMN total_value TYPE DOUBLE PRECISION;
+                    END IF;
+                    
+                    -- total_value used to be written by the application
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = 'balance_history'
+                          AND column_name = 'total_value'
+                          AND is_generated = 'NEVER'
+                    ) THEN
+                        ALTER TABLE balance_history DROP COLUMN total_value;
+                        ALTER TABLE balance_history ADD COLUMN total_value DOUBLE PRECISION
+                            GENERATED ALWAYS AS (
+                                spot_value + futures_value + coin_futures_value
+                                + cross_margin_value + isolated_margin_value
+                            ) STORED;
+                    END IF;
+                END
+                $$;
+                
+                -- Create indexes for better performance
                 CREATE INDEX IF NOT EXISTS idx_user_config_session_api 
                 ON user_config(session_id, api_name);
                 
                 CREATE INDEX IF NOT EXISTS idx_balance_history_session_type 
                 ON balance_history(session_id, wallet_type);
+                
+                -- Covers the per-session history read (filter, order and columns)
+                CREATE INDEX IF NOT EXISTS idx_balance_history_session_recorded 
+                ON balance_history(session_id, recorded_at DESC) 
+                INCLUDE (spot_value, futures_value, coin_futures_value, total_value);
+                
+                DROP INDEX IF EXISTS idx_balance_history_recorded_at;
             ''')
-        self.conn.commit()
+            conn.commit()
 
     def save_config(self, api_key, api_secret, total_investment, session_id, api_name='default'):
         """Save user configuration with session_id and api_name"""
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO user_config (api_key, api_secret, total_investment, session_id, api_name)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (api_key, api_secret, total_investment, session_id, api_name))
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise Exception(f"保存配置失败: {str(e)}")
+        with _conn() as conn:
+            try:
+                _ensure_prepared(conn)
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "EXECUTE save_cfg (%s, %s, %s, %s, %s)",
+                        (api_key, api_secret, total_investment, session_id, api_name)
+                    )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise Exception(f"保存配置失败: {str(e)}")
+            finally:
+                _CONFIG_CACHE.invalidate(session_id)
 
     def get_latest_config(self, session_id, api_name='default'):
         """Get specific API configuration for a session"""
+        cache_key = (session_id, 'latest', api_name)
+        hit, config = _CONFIG_CACHE.get(cache_key)
+        if hit:
+            return config
         try:
-            with self.conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute("""
-                    SELECT * FROM user_config 
-                    WHERE session_id = %s AND api_name = %s
-                """, (session_id, api_name))
-                return cur.fetchone()
+            with _conn() as conn:
+                _ensure_prepared(conn)
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute("EXECUTE get_cfg (%s, %s)", (session_id, api_name))
+                    config = cur.fetchone()
+            _CONFIG_CACHE.set(cache_key, config)
+            return config
         except Exception as e:
             raise Exception(f"获取配置失败: {str(e)}")
             
     def get_all_configs(self, session_id):
         """Get all API configurations for a session"""
+        cache_key = (session_id, 'all')
+        hit, configs = _CONFIG_CACHE.get(cache_key)
+        if hit:
+            return configs
         try:
-            with self.conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute("""
-                    SELECT * FROM user_config 
-                    WHERE session_id = %s
-                    ORDER BY api_name
-                """, (session_id,))
-                return cur.fetchall()
+            with _conn() as conn:
+                _ensure_prepared(conn)
+                with conn.cursor(cursor_factory=DictCursor) as cur:
+                    cur.execute("EXECUTE get_all_cfg (%s)", (session_id,))
+                    configs = cur.fetchall()
+            _CONFIG_CACHE.set(cache_key, configs)
+            return configs
         except Exception as e:
             raise Exception(f"获取配置失败: {str(e)}")
 
-    def clear_config(self, session_id):
-        """Clear user configurations and balance history for a specific session"""
+    def get_total_investment(self, session_id):
+        """Get the summed initial investment across a session's API configurations"""
+        cache_key = (session_id, 'total_investment')
+        hit, total = _CONFIG_CACHE.get(cache_key)
+        if hit:
+            return total
         try:
-            with self.conn.cursor() as cur:
-                # Clear user config for the session
-                cur.execute("DELETE FROM user_config WHERE session_id = %s", (session_id,))
-                # Clear balance history for the session
-                cur.execute("DELETE FROM balance_history WHERE session_id = %s", (session_id,))
-            self.conn.commit()
+            with _conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT COALESCE(SUM(total_investment), 0) FROM user_config WHERE session_id = %s",
+                        (session_id,)
+                    )
+                    total = float(cur.fetchone()[0])
+            _CONFIG_CACHE.set(cache_key, total)
+            return total
         except Exception as e:
-            self.conn.rollback()
-            raise Exception(f"清除配置失败: {str(e)}")
+            raise Exception(f"获取投资总额失败: {str(e)}")
 
-    def save_balance_history(self, wallet_values, session_id, wallet_type='spot', api_name='default'):
+    def delete_config(self, session_id, api_name):
+        """Delete a single API configuration for a session"""
+        with _conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        DELETE FROM user_config 
+                        WHERE session_id = %s AND api_name = %s
+                    """, (session_id, api_name))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise Exception(f"删除配置失败: {str(e)}")
+            finally:
+                _CONFIG_CACHE.invalidate(session_id)
+
+    def clear_config(self, session_id):
+        """Clear user configurations and balance history for a specific session"""
+        with _conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    # Clear user config for the session
+                    cur.execute("DELETE FROM user_config WHERE session_id = %s", (session_id,))
+                    # Clear balance history for the session
+                    cur.execute("DELETE FROM balance_history WHERE session_id = %s", (session_id,))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise Exception(f"清除配置失败: {str(e)}")
+            finally:
+                _CONFIG_CACHE.invalidate(session_id)
+                _HISTORY_CACHE.invalidate(session_id)
+                with _LAST_WRITE_LOCK:
+                    for key in [key for key in _LAST_WRITE if key[0] == session_id]:
+                        del _LAST_WRITE[key]
+
+    def save_balance_history(self, snapshots, session_id, wallet_type='spot'):
         """
         Save balance history with support for multiple wallet types
-        wallet_values: dict containing values for different wallet types
+        snapshots: list of dicts containing values for different wallet types
+        (plus an optional api_name), written in a single batched INSERT and one commit.
+        Snapshots unchanged since the last write within 30 seconds are skipped.
+        Returns True if any row was written
         """
-        try:
+        now = time.monotonic()
+        rows = []
+        written = {}
+        for wallet_values in snapshots:
             # Ensure all values are properly converted to float
-            spot_value = to_float(wallet_values.get('spot', 0))
-            futures_value = to_float(wallet_values.get('futures', 0))
-            coin_futures_value = to_float(wallet_values.get('coin_futures', 0))
-            cross_margin_value = to_float(wallet_values.get('cross_margin', 0))
-            isolated_margin_value = to_float(wallet_values.get('isolated_margin', 0))
-            
-            total_value = sum([
+            spot_value = float(wallet_values.get('spot', 0))
+            futures_value = float(wallet_values.get('futures', 0))
+            coin_futures_value = float(wallet_values.get('coin_futures', 0))
+            cross_margin_value = float(wallet_values.get('cross_margin', 0))
+            isolated_margin_value = float(wallet_values.get('isolated_margin', 0))
+            values = (
                 spot_value, futures_value, coin_futures_value,
                 cross_margin_value, isolated_margin_value
-            ])
+            )
             
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO balance_history 
-                    (spot_value, futures_value, coin_futures_value, cross_margin_value, 
-                     isolated_margin_value, total_value, wallet_type, session_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    spot_value, futures_value, coin_futures_value,
-                    cross_margin_value, isolated_margin_value,
-                    total_value, wallet_type, session_id
-                ))
-            self.conn.commit()
-        except Exception as e:
-            print(f"Error saving balance history: {str(e)}")
-            self.conn.rollback()
-            raise
+            key = (session_id, wallet_values.get('api_name', 'default'))
+            with _LAST_WRITE_LOCK:
+                last = _LAST_WRITE.get(key)
+            if last is not None and now - last[0] < _WRITE_MIN_INTERVAL and _unchanged(last[1], values):
+                continue
+            written[key] = values
+            
+            # total_value is a generated column computed by Postgres
+            rows.append(values + (wallet_type, session_id))
 
-    def get_balance_history(self, session_id, hours=None):
+        if not rows:
+            return False
+        
+        with _conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    execute_values(cur, """
+                        INSERT INTO balance_history 
+                        (spot_value, futures_value, coin_futures_value, cross_margin_value, 
+                         isolated_margin_value, wallet_type, session_id)
+                        VALUES %s
+                    """, rows, page_size=500)
+                conn.commit()
+            except Exception as e:
+                print(f"Error saving balance history: {str(e)}")
+                conn.rollback()
+                raise
+            finally:
+                _HISTORY_CACHE.invalidate(session_id)
+        
+        with _LAST_WRITE_LOCK:
+            # Entries past the window can no longer suppress a write
+            for key in [key for key, entry in _LAST_WRITE.items() if now - entry[0] >= _WRITE_MIN_INTERVAL]:
+                del _LAST_WRITE[key]
+            for key, values in written.items():
+                _LAST_WRITE[key] = (now, values)
+        return True
+
+    def bulk_save_balance_history(self, df, session_id, wallet_type='spot'):
+        """
+        Backfill balance history for a session with COPY FROM STDIN
+        df: DataFrame with spot_value, futures_value, coin_futures_value,
+        cross_margin_value, isolated_margin_value and recorded_at columns
+        (total_value is generated by Postgres)
+        """
+        columns = [
+            'spot_value', 'futures_value', 'coin_futures_value', 'cross_margin_value',
+            'isolated_margin_value', 'recorded_at'
+        ]
+        rows = df[columns].assign(wallet_type=wallet_type, session_id=session_id)
+        buf = io.StringIO()
+        rows.to_csv(buf, index=False, header=False)
+        buf.seek(0)
+        
+        with _conn() as conn:
+            try:
+                with conn.cursor() as cur:
+                    cur.copy_expert("""
+                        COPY balance_history 
+                        (spot_value, futures_value, coin_futures_value, cross_margin_value, 
+                         isolated_margin_value, recorded_at, wallet_type, session_id)
+                        FROM STDIN WITH CSV
+                    """, buf)
+                conn.commit()
+            except Exception as e:
+                print(f"Error bulk saving balance history: {str(e)}")
+                conn.rollback()
+                raise
+            finally:
+                _HISTORY_CACHE.invalidate(session_id)
+
+    def get_balance_history(self, session_id, hours=None, limit=MAX_HISTORY_ROWS, bucket=None):
+        """
+        Get the most recent balance history rows (at most `limit`) in ascending time order
+        bucket: optional bucket width in seconds; rows are averaged per bucket server-side
+        """
+        cache_key = (session_id, hours, limit, bucket)
+        hit, history = _HISTORY_CACHE.get(cache_key)
+        if hit:
+            return history
         try:
-            with self.conn.cursor(cursor_factory=DictCursor) as cur:
-                query = """
-                    SELECT 
-                        COALESCE(spot_value, 0) as spot_value,
-                        COALESCE(futures_value, 0) as futures_value,
-                        COALESCE(coin_futures_value, 0) as coin_futures_value,
-                        COALESCE(total_value, 0) as total_value,
-                        recorded_at AT TIME ZONE 'UTC' as recorded_at
-                    FROM balance_history 
-                    WHERE session_id = %s
-                """
+            with _conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if bucket:
+                    query = """
+                        SELECT 
+                            AVG(spot_value) as spot_value,
+                            AVG(futures_value) as futures_value,
+                            AVG(coin_futures_value) as coin_futures_value,
+                            AVG(total_value) as total_value,
+                            to_timestamp(floor(extract(epoch FROM recorded_at) / %s) * %s)
+                                AT TIME ZONE 'UTC' as recorded_at
+                        FROM balance_history 
+                        WHERE session_id = %s
+                    """
+                    params = [bucket, bucket, session_id]
+                else:
+                    query = """
+                        SELECT 
+                            spot_value,
+                            futures_value,
+                            coin_futures_value,
+                            total_value,
+                            recorded_at AT TIME ZONE 'UTC' as recorded_at
+                        FROM balance_history 
+                        WHERE session_id = %s
+                    """
+                    params = [session_id]
                 
                 if hours:
-                    query += " AND recorded_at >= NOW() - interval '%s hours'"
-                    cur.execute(query + " ORDER BY recorded_at ASC", (session_id, hours))
+                    query += " AND recorded_at >= NOW() - make_interval(hours => %s)"
+                    params.append(int(hours))
+                
+                if bucket:
+                    query += " GROUP BY 5 ORDER BY 5 DESC LIMIT %s"
                 else:
-                    cur.execute(query + " ORDER BY recorded_at ASC", (session_id,))
+                    query += " ORDER BY balance_history.recorded_at DESC LIMIT %s"
+                params.append(limit)
+                cur.execute(
+                    "SELECT * FROM (" + query + ") recent ORDER BY recorded_at ASC",
+                    params
+                )
                 
+                # RealDictCursor rows are plain dicts; recorded_at is NOT NULL and
+                # values arrive as float, so rows need no further conversion
                 result = cur.fetchall()
                 if not result:
                     return []
                 
-                formatted_result = []
-                for row in result:
-                    row_dict = dict(row)
-                    if row_dict['recorded_at'] and isinstance(row_dict['recorded_at'], datetime):
-                        # Convert decimal values to float
-                        row_dict['spot_value'] = to_float(row_dict['spot_value'])
-                        row_dict['futures_value'] = to_float(row_dict['futures_value'])
-                        row_dict['coin_futures_value'] = to_float(row_dict['coin_futures_value'])
-                        row_dict['total_value'] = to_float(row_dict['total_value'])
-                        formatted_result.append(row_dict)
-                    else:
-                        print(f"Invalid timestamp format: {row_dict['recorded_at']}")
-                        continue
-                
-                return formatted_result
+                _HISTORY_CACHE.set(cache_key, result)
+                return result
 
         except Exception as e:
             print(f"Error retrieving balance history: {str(e)}")
             return []
+
+@st.cache_resource
+def get_db():
+    """Process-wide Database instance reused across Streamlit reruns"""
+    return Database()
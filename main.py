@@ -1,11 +1,15 @@
+import functools
 import streamlit as st
 import uuid
-from database.db import Database
-from services.binance_service import BinanceService
+import pandas as pd
+from types import MappingProxyType
+from database.db import get_db
+from services.binance_service import get_binance_service
 from components.api_setup import render_api_setup
 from components.wallet_display import render_wallet_display
+from components.charts import load_balance_history
 from binance.exceptions import BinanceAPIException
-from utils.calculations import calculate_profit_rate, format_currency, format_percentage, to_float
+from utils.calculations import calculate_profit_rate, format_currency, format_percentage
 
 st.set_page_config(
     page_title="币安钱包追踪器",
@@ -13,6 +17,15 @@ st.set_page_config(
     layout="wide"
 )
 
+WALLET_TYPES = ['spot', 'futures', 'coin_futures', 'cross_margin', 'isolated_margin']
+
+_API_ERROR_MESSAGES = MappingProxyType({
+    -2015: "API权限无效",
+    -1021: "请求超时",
+    -1022: "签名无效",
+    -1102: "参数错误"
+})
+
 def initialize_session():
     """Initialize or get existing session ID"""
     if 'session_id' not in st.session_state:
@@ -24,7 +37,7 @@ def main():
     
     # Initialize database connection
     try:
-        db = Database()
+        db = get_db()
     except Exception as e:
         st.error("数据库连接失败")
         return
@@ -50,30 +63,40 @@ def main():
             return
             
         try:
-            # Initialize and calculate aggregated wallet values
-            total_wallet_values = {
-                'spot': 0.0,
-                'futures': 0.0,
-                'coin_futures': 0.0,
-                'cross_margin': 0.0,
-                'isolated_margin': 0.0
-            }
+            # The full ticker is downloaded by the first API that holds a non-USDT
+            # asset and reused by the remaining APIs in this rerun; USDT-only
+            # accounts never trigger it
+            load_prices = functools.cache(lambda: binance_service.get_current_prices())
             
-            # Process each API configuration first to calculate totals
+            # Process each API configuration first to calculate totals. Each result
+            # (wallet values, or the error from the spot account fetch) is reused
+            # by the per-API display below instead of fetching again
+            snapshots = []
+            wallet_results = []
             for config in configs:
                 try:
-                    binance_service = BinanceService(config['api_key'], config['api_secret'])
-                    wallet_values = binance_service.get_all_wallet_values()
+                    binance_service = get_binance_service(config['api_key'], config['api_secret'])
+                    wallet_values = binance_service.get_all_wallet_values(load_prices=load_prices)
                     
-                    # Aggregate values
-                    for wallet_type in total_wallet_values:
-                        total_wallet_values[wallet_type] += float(wallet_values.get(wallet_type, 0))
-                        
-                    # Save individual API balance history
-                    db.save_balance_history(wallet_values, session_id, api_name=config['api_name'])
+                    # Collect individual API balance snapshot
+                    snapshots.append({**wallet_values, 'api_name': config['api_name']})
+                    wallet_results.append(wallet_values)
                 except Exception as e:
-                    st.error(f"API '{config['api_name']}' 连接失败: {str(e)}")
-                    continue
+                    # Reported by render_wallet_display's permission check
+                    wallet_results.append(e)
+            
+            # Aggregate wallet values across APIs (one row per API, one column per wallet type)
+            wallet_df = pd.DataFrame(snapshots, columns=WALLET_TYPES, dtype='float64').fillna(0.0)
+            total_wallet_values = wallet_df.sum().to_dict()
+            
+            # Save all API balance snapshots in one batch
+            if snapshots:
+                try:
+                    if db.save_balance_history(snapshots, session_id):
+                        # New snapshots were written, drop cached chart history
+                        load_balance_history.clear()
+                except Exception as e:
+                    st.error(f"保存历史数据失败: {str(e)}")
             
             # Add refresh button to top right
             col1, col2 = st.columns([3, 1])
@@ -85,8 +108,8 @@ def main():
             st.markdown("# 💰 总资产概览")
             st.divider()
             
-            total_investment = sum(float(config['total_investment']) for config in configs)
-            total_value = sum(float(value) for value in total_wallet_values.values())
+            total_investment = db.get_total_investment(session_id)
+            total_value = float(wallet_df.to_numpy().sum())
             
             # Calculate profits
             total_profit_amount = total_value - total_investment
@@ -120,20 +143,14 @@ def main():
             st.divider()
             
             # Display individual API wallets
-            for config in configs:
+            for config, wallet_result in zip(configs, wallet_results):
                 try:
-                    binance_service = BinanceService(config['api_key'], config['api_secret'])
+                    binance_service = get_binance_service(config['api_key'], config['api_secret'])
                     st.subheader(f"📊 {config['api_name']}")
-                    render_wallet_display(binance_service, config)
+                    render_wallet_display(binance_service, config, wallet_result)
                     st.divider()  # Add divider between API sections
                 except BinanceAPIException as e:
-                    error_messages = {
-                        -2015: "API权限无效",
-                        -1021: "请求超时",
-                        -1022: "签名无效",
-                        -1102: "参数错误"
-                    }
-                    error_msg = error_messages.get(e.code, f"币安API错误 (代码: {e.code})")
+                    error_msg = _API_ERROR_MESSAGES.get(e.code, f"币安API错误 (代码: {e.code})")
                     st.error(f"API '{config['api_name']}' 连接失败: {error_msg}\n{e.message}")
                 except Exception as e:
                     st.error(f"API '{config['api_name']}' 连接失败: {str(e)}")
@@ -1,37 +1,105 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
 from binance.client import Client
+from binance.exceptions import BinanceAPIException, BinanceRequestException
+import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
-from datetime import datetime
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖，未安装时使用requests自带的json解析
+    orjson = None
+
+def _create_shared_session():
+    """所有客户端共用的HTTP会话（keep-alive连接池），不含API Key请求头"""
+    session = requests.Session()
+    session.headers.update({
+        "Accept": "application/json",
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36"
+    })
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50)
+    session.mount('https://', adapter)
+    return session
+
+_SHARED_SESSION = _create_shared_session()
+
+class _OrjsonClient(Client):
+    """用orjson解析响应体的Client（行情等大响应的JSON解码更快）"""
+
+    @staticmethod
+    def _handle_response(response):
+        if not (200 <= response.status_code < 300):
+            raise BinanceAPIException(response, response.status_code, response.text)
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            raise BinanceRequestException('Invalid Response: %s' % response.text)
+
+_CLIENT_CLASS = _OrjsonClient if orjson is not None else Client
+
+# 全市场行情的进程内缓存，多个账户在同一次刷新中共用
+PRICES_TTL = 3.0
+_PRICES_CACHE = {'t': 0.0, 'v': None}
+_PRICES_LOCK = threading.Lock()
 
 class BinanceService:
-    def __init__(self, api_key, api_secret):
-        self.client = Client(api_key, api_secret)
+    __slots__ = ('api_key', 'api_secret', 'prices_ttl', 'client')
+
+    def __init__(self, api_key, api_secret, prices_ttl=PRICES_TTL):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        # 行情缓存的有效秒数，0表示每次都重新获取
+        self.prices_ttl = prices_ttl
+        # API Key随每个请求发送，这样不同账户可以共用同一个会话；跳过构造时的ping
+        self.client = _CLIENT_CLASS(
+            api_key, api_secret,
+            requests_params={"headers": {"X-MBX-APIKEY": api_key}, "timeout": 10},
+            ping=False
+        )
+        self.client.session = _SHARED_SESSION
 
     def get_spot_balance(self):
-        """获取现货账户余额"""
-        account = self.client.get_account()
-        balances = pd.DataFrame(account['balances'])
-        balances['free'] = pd.to_numeric(balances['free'])
-        balances['locked'] = pd.to_numeric(balances['locked'])
-        balances['total'] = balances['free'] + balances['locked']
-        return balances[balances['total'] > 0]
+        """获取现货账户余额（按资产索引的数量Series，供展示使用）"""
+        assets, totals = self.get_spot_balance_raw()
+        return pd.Series(totals, index=assets, dtype='float64')
+
+    def get_spot_balance_raw(self):
+        """获取现货账户余额 (资产数组, 数量数组)，估值时无需构建pandas对象"""
+        return self._parse_spot_balance(self.client.get_account())
+
+    @staticmethod
+    def _parse_spot_balance(account):
+        """解析现货账户信息为 (资产数组, 可用+冻结数量数组)，只保留非零余额"""
+        balances = account['balances']
+        count = len(balances)
+        # 直接解析为float64数组，避免object列再做数值转换
+        free = np.fromiter((float(balance['free']) for balance in balances), dtype=np.float64, count=count)
+        locked = np.fromiter((float(balance['locked']) for balance in balances), dtype=np.float64, count=count)
+        assets = np.array([balance['asset'] for balance in balances], dtype=object)
+        total = free + locked
+        mask = total > 0
+        return assets[mask], total[mask]
 
     def get_futures_balance(self):
         """获取U本位合约账户余额"""
-        # Get account balance
-        futures_account_balance = self.client.futures_account_balance()
-        balance_df = pd.DataFrame(futures_account_balance)
-        
-        # Get futures account info including positions
-        futures_account = self.client.futures_account()
-        positions = futures_account['positions']
+        return self._parse_futures_balance(self.client.futures_account())
+
+    @staticmethod
+    def _parse_futures_balance(futures_account):
+        """解析U本位合约账户：各资产钱包余额，并把持仓未实现盈亏计入USDT余额"""
+        balance_df = pd.DataFrame(futures_account['assets'], columns=['asset', 'walletBalance'])
+        balance_df = balance_df.rename(columns={'walletBalance': 'balance'})
+        balance_df['balance'] = pd.to_numeric(balance_df['balance'])
         
         # Calculate total unrealized profit
-        total_unrealized_profit = sum(float(position['unrealizedProfit']) for position in positions)
+        total_unrealized_profit = sum(float(position['unrealizedProfit']) for position in futures_account['positions'])
         
-        # Add unrealized profit to the balance dataframe
-        if not balance_df.empty and 'balance' in balance_df.columns:
-            balance_df.loc[balance_df['asset'] == 'USDT', 'balance'] = \
-                float(balance_df.loc[balance_df['asset'] == 'USDT', 'balance'].iloc[0]) + total_unrealized_profit
+        # Add unrealized profit to the USDT balance
+        balance_df.loc[balance_df['asset'] == 'USDT', 'balance'] += total_unrealized_profit
             
         return balance_df
 
@@ -41,127 +109,242 @@ class BinanceService:
         return pd.DataFrame(coin_futures_account)
 
     def get_cross_margin_balance(self):
-        """获取全仓杠杆账户余额"""
+        """获取全仓杠杆账户余额 {资产: 净资产}"""
         try:
-            margin_account = self.client.get_margin_account()
-            balances = pd.DataFrame(margin_account['userAssets'])
-            balances['free'] = pd.to_numeric(balances['free'])
-            balances['locked'] = pd.to_numeric(balances['locked'])
-            balances['borrowed'] = pd.to_numeric(balances['borrowed'])
-            balances['interest'] = pd.to_numeric(balances['interest'])
-            balances['netAsset'] = pd.to_numeric(balances['netAsset'])
-            return balances[balances['netAsset'] > 0]
+            return self._parse_cross_margin_balance(self.client.get_margin_account())
         except Exception as e:
             print(f"获取全仓杠杆账户余额失败: {str(e)}")
+            return {}
+
+    @staticmethod
+    def _parse_cross_margin_balance(margin_account):
+        """解析全仓杠杆账户信息为 {资产: 净资产}，只保留正净资产"""
+        balances = {}
+        for user_asset in margin_account['userAssets']:
+            net_asset = float(user_asset['netAsset'])
+            if net_asset > 0:
+                balances[user_asset['asset']] = net_asset
+        return balances
+
+    def get_isolated_margin_balance(self, prices=None):
+        """获取逐仓杠杆账户余额（prices为行情快照，未传入时获取一次）"""
+        try:
+            isolated_margin_accounts = self._get_isolated_margin_accounts()
+            if prices is None:
+                prices = self.get_current_prices()
+            return self._parse_isolated_margin_balance(isolated_margin_accounts, prices)
+        except Exception as e:
+            print(f"获取逐仓杠杆账户余额失败: {str(e)}")
             return pd.DataFrame()
 
-    def get_isolated_margin_balance(self):
-        """获取逐仓杠杆账户余额"""
+    def _get_isolated_margin_accounts(self):
+        """获取逐仓杠杆账户原始信息，失败时返回空字典"""
         try:
-            isolated_margin_accounts = self.client.get_isolated_margin_account()
-            if not isinstance(isolated_margin_accounts, dict) or 'assets' not in isolated_margin_accounts:
-                return pd.DataFrame()
-
-            all_balances = []
-            for account in isolated_margin_accounts['assets']:
-                if account.get('enabled', False):  # 只处理已启用的账户
-                    base_asset = account.get('baseAsset', {})
-                    quote_asset = account.get('quoteAsset', {})
-                    
-                    # 计算基础资产净值
-                    base_net_asset = float(base_asset.get('netAsset', 0))
-                    if base_net_asset > 0:
-                        symbol_pair = f"{base_asset.get('asset')}USDT"
-                        try:
-                            price = float(self.client.get_symbol_ticker(symbol=symbol_pair)['price'])
-                            base_value = base_net_asset * price
-                        except:
-                            base_value = 0
-                    else:
-                        base_value = 0
-                    
-                    # 计算报价资产净值（如果是USDT则直接使用）
-                    quote_net_asset = float(quote_asset.get('netAsset', 0))
-                    quote_value = quote_net_asset if quote_asset.get('asset') == 'USDT' else 0
-                    
-                    total_value = base_value + quote_value
-                    if total_value > 0:
-                        all_balances.append({
-                            'symbol': account.get('symbol', 'UNKNOWN'),
-                            'netAsset': total_value
-                        })
-
-            return pd.DataFrame(all_balances)
+            return self.client.get_isolated_margin_account()
         except Exception as e:
             print(f"获取逐仓杠杆账户余额失败: {str(e)}")
+            return {}
+
+    @staticmethod
+    def _parse_isolated_margin_balance(isolated_margin_accounts, prices):
+        """解析逐仓杠杆账户，基础资产按行情快照prices折算为USDT"""
+        if not isinstance(isolated_margin_accounts, dict) or 'assets' not in isolated_margin_accounts:
             return pd.DataFrame()
 
-    def get_current_prices(self, symbols):
-        """获取当前价格信息"""
-        prices = self.client.get_symbol_ticker()
+        all_balances = []
+        for account in isolated_margin_accounts['assets']:
+            if account.get('enabled', False):  # 只处理已启用的账户
+                base_asset = account.get('baseAsset', {})
+                quote_asset = account.get('quoteAsset', {})
+                
+                # 计算基础资产净值
+                base_net_asset = float(base_asset.get('netAsset', 0))
+                if base_net_asset > 0:
+                    asset = base_asset.get('asset')
+                    price = prices.get(f"{asset}USDT")
+                    if price is None:
+                        # 没有USDT交易对时经BTC折算
+                        price = prices.get(f"{asset}BTC", 0.0) * prices.get('BTCUSDT', 0.0)
+                    base_value = base_net_asset * price
+                else:
+                    base_value = 0
+                
+                # 计算报价资产净值（如果是USDT则直接使用）
+                quote_net_asset = float(quote_asset.get('netAsset', 0))
+                quote_value = quote_net_asset if quote_asset.get('asset') == 'USDT' else 0
+                
+                total_value = base_value + quote_value
+                if total_value > 0:
+                    all_balances.append({
+                        'symbol': account.get('symbol', 'UNKNOWN'),
+                        'netAsset': total_value
+                    })
+
+        return pd.DataFrame(all_balances)
+
+    def get_current_prices(self, symbols=None):
+        """
+        获取当前价格信息（进程内缓存所有实例共用，按本实例的prices_ttl判断是否过期）
+        symbols: 需要的交易对，只返回其中有行情的部分；为空时返回全市场行情
+        """
+        with _PRICES_LOCK:
+            if _PRICES_CACHE['v'] is not None and time.monotonic() - _PRICES_CACHE['t'] < self.prices_ttl:
+                prices = _PRICES_CACHE['v']
+            else:
+                prices = None
+        if prices is None:
+            prices = self._parse_prices(self.client.get_symbol_ticker())
+            with _PRICES_LOCK:
+                _PRICES_CACHE['t'] = time.monotonic()
+                _PRICES_CACHE['v'] = prices
+        if not symbols:
+            return prices
+        return {symbol: prices[symbol] for symbol in symbols if symbol in prices}
+
+    @staticmethod
+    def _parse_prices(prices):
+        """把行情列表转换为 {交易对: 价格} 字典"""
         return {item['symbol']: float(item['price']) for item in prices}
 
+    @staticmethod
+    def _asset_prices(assets, prices):
+        """
+        资产数组对应的USDT价格：优先 {资产}USDT，USDT按1计
+        没有USDT交易对的资产按 {资产}BTC × BTCUSDT 折算，都没有时按0计
+        """
+        # 转为Arrow字符串数组，拼接交易对和比较USDT走Arrow的向量化内核
+        assets = pd.array(assets, dtype='string[pyarrow]')
+        price = prices.reindex(assets + 'USDT').to_numpy(dtype=np.float64)
+        bridged = prices.reindex(assets + 'BTC').to_numpy(dtype=np.float64) * prices.get('BTCUSDT', np.nan)
+        price = np.where(np.isnan(price), bridged, price)
+        is_usdt = (assets == 'USDT').to_numpy(dtype=bool, na_value=False)
+        return np.where(is_usdt, 1.0, np.nan_to_num(price, nan=0.0))
+
+    @staticmethod
+    def _asset_amounts(balances, balance_type):
+        """把现货/合约/全仓杠杆余额统一为 (资产object数组, 数量float64数组)"""
+        if balance_type == 'spot' and isinstance(balances, tuple):
+            return balances
+        if len(balances) == 0:
+            return np.empty(0, dtype=object), np.empty(0, dtype=np.float64)
+        if balance_type in ['spot', 'cross_margin']:
+            amounts = pd.Series(balances, dtype='float64')
+            return amounts.index.to_numpy(dtype=object), amounts.to_numpy()
+        return (
+            balances['asset'].to_numpy(dtype=object),
+            pd.to_numeric(balances['balance']).to_numpy(dtype=np.float64)
+        )
+
     def calculate_total_value(self, balances, prices, balance_type='spot'):
-        """计算特定类型账户的总价值"""
-        total_usdt = 0
+        """
+        计算特定类型账户的总价值
+        balances: 现货为 (资产数组, 数量数组) 或按资产索引的数量Series，
+        全仓杠杆为 {资产: 数量} 字典，其余类型为余额表
+        """
+        if not isinstance(prices, pd.Series):
+            prices = pd.Series(prices, dtype='float64')
         
-        if balance_type == 'spot':
-            for _, balance in balances.iterrows():
-                symbol = balance['asset']
-                if symbol == 'USDT':
-                    total_usdt += float(balance['total'])
-                else:
-                    symbol_pair = f"{symbol}USDT"
-                    if symbol_pair in prices:
-                        total_usdt += float(balance['total']) * prices[symbol_pair]
-                        
-        elif balance_type == 'cross_margin':
-            for _, balance in balances.iterrows():
-                symbol = balance['asset']
-                if symbol == 'USDT':
-                    total_usdt += float(balance['netAsset'])
-                else:
-                    symbol_pair = f"{symbol}USDT"
-                    if symbol_pair in prices:
-                        total_usdt += float(balance['netAsset']) * prices[symbol_pair]
-                        
-        elif balance_type == 'isolated_margin':
+        if balance_type == 'isolated_margin':
             # 由于已经在get_isolated_margin_balance中转换为USDT，直接累加
-            total_usdt = balances['netAsset'].sum() if not balances.empty else 0
-                    
-        elif balance_type in ['futures', 'coin_futures']:
-            for _, balance in balances.iterrows():
-                if balance['asset'] == 'USDT':
-                    total_usdt += float(balance['balance'])
-                else:
-                    symbol_pair = f"{balance['asset']}USDT"
-                    if symbol_pair in prices:
-                        total_usdt += float(balance['balance']) * prices[symbol_pair]
+            return float(balances['netAsset'].sum()) if len(balances) else 0.0
+        
+        if balance_type in ['spot', 'futures', 'coin_futures', 'cross_margin']:
+            assets, amounts = self._asset_amounts(balances, balance_type)
+            # 数量与价格按同一顺序对齐，一次点积得到总值
+            return float(amounts.dot(self._asset_prices(assets, prices))) if len(assets) else 0.0
                         
-        return total_usdt
+        return 0.0
+
+    def _build_wallet_values(self, prices, spot_balances, futures_balances, coin_futures_balances,
+                             cross_margin_balances, isolated_margin_balances):
+        """计算各类型账户价值（现货、合约和全仓杠杆合并为一次估值）"""
+        # 行情只转换一次为Series，供各类型账户共用
+        prices = pd.Series(prices, dtype='float64')
+        wallet_types = ['spot', 'futures', 'coin_futures', 'cross_margin']
+        parts = [
+            self._asset_amounts(balances, balance_type)
+            for balances, balance_type in zip(
+                [spot_balances, futures_balances, coin_futures_balances, cross_margin_balances],
+                wallet_types
+            )
+        ]
+        assets = np.concatenate([part[0] for part in parts])
+        amounts = np.concatenate([part[1] for part in parts])
+        # 每行所属的钱包类型，按类型分组求和
+        segments = np.repeat(np.arange(len(parts)), [len(part[0]) for part in parts])
+        values = np.bincount(
+            segments, weights=amounts * self._asset_prices(assets, prices), minlength=len(parts)
+        )
+        
+        wallet_values = {wallet_type: float(value) for wallet_type, value in zip(wallet_types, values)}
+        wallet_values['isolated_margin'] = self.calculate_total_value(
+            isolated_margin_balances, prices, 'isolated_margin'
+        )
+        return wallet_values
 
-    def get_all_wallet_values(self):
-        """获取所有钱包类型的价值"""
+    @staticmethod
+    def _price_symbols(spot_balances, futures_balances, coin_futures_balances,
+                       cross_margin_balances, isolated_margin_accounts):
+        """
+        持有的非USDT资产估值需要的交易对集合（只有USDT时为空，无需下载行情）
+        spot_balances: get_spot_balance_raw返回的 (资产数组, 数量数组)
+        """
+        assets = {asset for asset in spot_balances[0] if asset != 'USDT'}
+        assets.update(asset for asset in cross_margin_balances if asset != 'USDT')
+        for balances in (futures_balances, coin_futures_balances):
+            if len(balances):
+                held = (balances['asset'] != 'USDT') & (pd.to_numeric(balances['balance']) != 0)
+                assets.update(balances.loc[held, 'asset'])
+        if not isinstance(isolated_margin_accounts, dict):
+            isolated_margin_accounts = {}
+        for account in isolated_margin_accounts.get('assets', []):
+            base_asset = account.get('baseAsset', {})
+            if account.get('enabled', False) and float(base_asset.get('netAsset', 0)) > 0:
+                assets.add(base_asset.get('asset'))
+        if not assets:
+            return set()
+        # 同时请求BTC交易对，供没有USDT交易对的资产经BTC折算
+        symbols = {f"{asset}USDT" for asset in assets} | {f"{asset}BTC" for asset in assets}
+        symbols.add('BTCUSDT')
+        return symbols
+
+    def get_all_wallet_values(self, prices=None, load_prices=None):
+        """
+        获取所有钱包类型的价值
+        prices: 共享的行情快照；未传入时只在持有非USDT资产时才获取行情
+        load_prices: 返回全市场行情的函数，供多个账户在一次刷新中共用同一份行情
+        现货账户请求同时用于验证API权限，失败时抛出异常；其余失败返回空字典
+        """
+        # 各接口互不依赖，先并发请求各类型账户余额
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            balance_futures = [
+                executor.submit(self.get_spot_balance_raw),
+                executor.submit(self.get_futures_balance),
+                executor.submit(self.get_coin_futures_balance),
+                executor.submit(self.get_cross_margin_balance),
+                executor.submit(self._get_isolated_margin_accounts)
+            ]
+        spot_balances = balance_futures[0].result()
+        
         try:
-            prices = self.get_current_prices([])
-            
-            # 获取各类型账户余额
-            spot_balances = self.get_spot_balance()
-            futures_balances = self.get_futures_balance()
-            coin_futures_balances = self.get_coin_futures_balance()
-            cross_margin_balances = self.get_cross_margin_balance()
-            isolated_margin_balances = self.get_isolated_margin_balance()
+            balances = [spot_balances] + [future.result() for future in balance_futures[1:]]
             
-            # 计算各类型账户价值
-            wallet_values = {
-                'spot': self.calculate_total_value(spot_balances, prices, 'spot'),
-                'futures': self.calculate_total_value(futures_balances, prices, 'futures'),
-                'coin_futures': self.calculate_total_value(coin_futures_balances, prices, 'coin_futures'),
-                'cross_margin': self.calculate_total_value(cross_margin_balances, prices, 'cross_margin'),
-                'isolated_margin': self.calculate_total_value(isolated_margin_balances, prices, 'isolated_margin')
-            }
+            # 没有共享行情时，只在持有非USDT资产时才获取行情，并只保留需要的交易对
+            if prices is None:
+                symbols = self._price_symbols(*balances)
+                if not symbols:
+                    prices = {}
+                else:
+                    ticker = load_prices() if load_prices is not None else self.get_current_prices()
+                    prices = {symbol: ticker[symbol] for symbol in symbols if symbol in ticker}
+            balances[4] = self._parse_isolated_margin_balance(balances[4], prices)
             
-            return wallet_values
+            return self._build_wallet_values(prices, *balances)
         except Exception as e:
             print(f"获取钱包价值失败: {str(e)}")
             return {}
+
+@st.cache_resource(ttl=3600, max_entries=32)
+def get_binance_service(api_key, api_secret):
+    """按密钥缓存BinanceService（HTTP连接池由所有实例共享，过期或超出数量的实例自动释放）"""
+    return BinanceService(api_key, api_secret)
@@ -1,23 +1,73 @@
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 
-def to_float(value):
-    """Convert any numeric value to float."""
-    if isinstance(value, Decimal):
-        return float(value)
-    return float(value)
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to NumPy
+    njit = None
+
+# Bound format methods, so the template is parsed once at import
+_CURRENCY_FMT = '${:,.2f}'.format
+_PERCENTAGE_FMT = '{:.2f}%'.format
+
+_CENT = Decimal('0.01')
 
 def calculate_profit_rate(current_value, initial_investment):
     """Calculate profit rate with proper type conversion."""
-    current_value = to_float(current_value)
-    initial_investment = to_float(initial_investment)
-    if initial_investment == 0:
+    if type(initial_investment) is not float:
+        initial_investment = float(initial_investment)
+    if not initial_investment:
         return 0
+    if type(current_value) is not float:
+        current_value = float(current_value)
     return ((current_value - initial_investment) / initial_investment) * 100
 
+def to_cents(value):
+    """Convert a USD amount to integer cents, rounding half up to the nearest cent."""
+    return int(Decimal(str(value)).quantize(_CENT, ROUND_HALF_UP) * 100)
+
+def calculate_profit_rate_bps(current_cents, initial_cents):
+    """Calculate profit rate in integer basis points from integer cent amounts (rounded half up)."""
+    if not initial_cents:
+        return 0
+    return ((current_cents - initial_cents) * 20000 + initial_cents) // (2 * initial_cents)
+
+def _profit_rates_loop(current_values, initial_investments):
+    out = np.empty_like(current_values)
+    for i in range(current_values.size):
+        if initial_investments[i] == 0.0:
+            out[i] = 0.0
+        else:
+            out[i] = (current_values[i] - initial_investments[i]) / initial_investments[i] * 100.0
+    return out
+
+_profit_rates_nb = njit(cache=True)(_profit_rates_loop) if njit is not None else None
+
+def calculate_profit_rates(current_values, initial_investments):
+    """Calculate profit rates for arrays of values (numba-compiled when available)."""
+    current_values = np.ascontiguousarray(current_values, dtype=np.float64)
+    initial_investments = np.ascontiguousarray(
+        np.broadcast_to(np.asarray(initial_investments, dtype=np.float64), current_values.shape)
+    )
+    if _profit_rates_nb is not None:
+        return _profit_rates_nb(current_values, initial_investments)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = (current_values - initial_investments) / initial_investments * 100.0
+    return np.where(initial_investments == 0.0, 0.0, rates)
+
 def format_currency(value):
     """Format currency value with proper type conversion."""
-    return f"${to_float(value):,.2f}"
+    return _CURRENCY_FMT(value if type(value) is float else float(value))
 
 def format_percentage(value):
     """Format percentage with proper type conversion."""
-    return f"{to_float(value):.2f}%"
+    return _PERCENTAGE_FMT(value if type(value) is float else float(value))
+
+def format_currency_series(series):
+    """Format a pandas Series of values as currency strings in one pass."""
+    return series.astype('float64').map(_CURRENCY_FMT)
+
+def format_percentage_series(series):
+    """Format a pandas Series of values as percentage strings in one pass."""
+    return series.astype('float64').map(_PERCENTAGE_FMT)